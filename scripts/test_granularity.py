@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# This script measures how benchmark performance scales with the size of a GPU
+# compute partition. It sweeps partition sizes from a single TPC up to the
+# entire GPU for each requested partitioning mechanism: MPS thread
+# percentages, libsmctrl SM masks (requires a libsmctrl-enabled build of the
+# runner; see README.md), and MiG GPU instances (requires a MiG-capable GPU
+# and sudo to reconfigure it). One ./bin/runner process is launched per
+# (method, partition size) pair, and each run logs one result file that can be
+# plotted with view_scatterplots.py, with the partition size as the X value.
+#
+# Usage of this script:
+#
+# rm results/*.json
+# python scripts/test_granularity.py
+# python scripts/view_scatterplots.py
+#
+# Requires Python 3
+import argparse
+import json
+import os
+import subprocess
+import time
+
+# pysmctrl is only needed to auto-detect the GPU's TPC count; a manually
+# specified --tpc_count works without it.
+try:
+    import pysmctrl
+except ImportError:
+    pysmctrl = None
+
+# nvidia-smi GPU instance profile IDs, keyed by the number of compute slices
+# each profile contains. MiG-capable GPUs expose seven compute slices total.
+MIG_SLICE_PROFILES = {
+    1: 19,
+    2: 14,
+    3: 9,
+    4: 5,
+    7: 0
+}
+
+class CommandFailedError(Exception):
+    """Raised when an nvidia-smi reconfiguration command fails."""
+    pass
+
+class MiGUnsupportedError(Exception):
+    """Raised when MiG partitioning is requested, but the GPU doesn't support
+    MiG or MiG mode is disabled."""
+    pass
+
+def check_run_result(result):
+    """Takes a CompletedProcess returned by subprocess.run and raises a
+    CommandFailedError if the command exited with a nonzero status. Includes
+    any captured stderr output in the exception message."""
+    if result.returncode == 0:
+        return
+    message = result.stderr.decode("utf-8", "replace").strip()
+    if message != "":
+        message = ": " + message
+    raise CommandFailedError("Command '%s' failed with status %d%s" % (
+        " ".join(result.args), result.returncode, message))
+
+# Whether the GPU supports MiG; None until the first check_mig_capable call.
+mig_capable = None
+def check_mig_capable():
+    """Raises MiGUnsupportedError if MiG is unsupported or disabled on this
+    GPU. MiG capability is static for the duration of a run, so the
+    ~200ms nvidia-smi query behind this check only happens once per
+    process."""
+    global mig_capable
+    if mig_capable is None:
+        result = subprocess.run(["nvidia-smi", "mig",
+            "--list-gpu-instance-profiles"], capture_output=True)
+        # nvidia-smi exits with status 6 when MiG is unsupported or disabled.
+        mig_capable = result.returncode != 6
+        if mig_capable:
+            check_run_result(result)
+    if not mig_capable:
+        raise MiGUnsupportedError("MiG is unsupported or disabled on this "
+            "GPU.")
+
+def setup_mig_instance(active_tpcs, total_tpcs):
+    """Reconfigures the GPU to contain a single MiG GPU instance covering
+    approximately active_tpcs of the GPU's total_tpcs TPCs. MiG instances only
+    come in a few fixed sizes, so this selects the profile closest to the
+    requested fraction of the GPU. Requires MiG mode to already be enabled,
+    and sudo access for the reconfiguration commands."""
+    check_mig_capable()
+    requested_slices = (7.0 * active_tpcs) / total_tpcs
+    slice_count = min(MIG_SLICE_PROFILES,
+        key=lambda s: abs(s - requested_slices))
+    # Tear down any instances left over from a previous partition size. These
+    # commands fail harmlessly if no instances exist, so don't check them.
+    subprocess.run(["sudo", "nvidia-smi", "mig",
+        "--destroy-compute-instance"], capture_output=True)
+    subprocess.run(["sudo", "nvidia-smi", "mig", "--destroy-gpu-instance"],
+        capture_output=True)
+    result = subprocess.run(["sudo", "nvidia-smi", "mig",
+        "--create-gpu-instance", str(MIG_SLICE_PROFILES[slice_count]),
+        "--default-compute-instance"], capture_output=True)
+    check_run_result(result)
+
+# Maps (active_tpcs, total_tpcs) pairs to precomputed partition settings, so
+# repeated sweeps don't rebuild the same strings for every runner launch.
+partition_settings = {}
+def get_partition_settings(active_tpcs, total_tpcs):
+    """Returns an (sm_mask string, MPS thread percentage) pair for a
+    partition containing active_tpcs of total_tpcs TPCs, computing each pair
+    only once."""
+    key = (active_tpcs, total_tpcs)
+    if key in partition_settings:
+        return partition_settings[key]
+    # The runner expects a mask of TPCs to *disable*; the "~" prefix inverts
+    # it into a mask of TPCs to enable.
+    sm_mask = "~" + hex((1 << active_tpcs) - 1)
+    percent_active = 100.0 * float(active_tpcs) / float(total_tpcs)
+    partition_settings[key] = (sm_mask, percent_active)
+    return partition_settings[key]
+
+def generate_benchmark_config(part_method, active_tpcs, total_tpcs,
+        tpc_offset=0):
+    """Returns the per-benchmark portion of a config that runs the
+    Mandelbrot-set benchmark on a partition containing active_tpcs of the
+    GPU's total_tpcs TPCs. For "libsmctrl", tpc_offset places the partition
+    at TPCs [tpc_offset, tpc_offset + active_tpcs) so concurrent jobs can be
+    given disjoint TPC ranges. MiG partitions are created by nvidia-smi
+    rather than per-benchmark settings, so for "mig" this contains no
+    partitioning fields; see generate_config."""
+    benchmark_config = {
+        "label": str(active_tpcs),
+        "log_name": "granularity_%s_%d_tpcs.json" % (part_method,
+            active_tpcs),
+        "filename": "./bin/mandelbrot.so",
+        "thread_count": 512,
+        "block_count": 2 * total_tpcs,
+        "data_size": 1024 * 1024,
+        "additional_info": 2000
+    }
+    if part_method == "mps":
+        benchmark_config["mps_thread_percentage"] = get_partition_settings(
+            active_tpcs, total_tpcs)[1]
+    elif part_method == "libsmctrl":
+        if tpc_offset == 0:
+            benchmark_config["sm_mask"] = get_partition_settings(active_tpcs,
+                total_tpcs)[0]
+        else:
+            # Masks at a nonzero offset depend on where the scheduler placed
+            # the job, so they must be built per launch rather than taken
+            # from the offset-0 cache.
+            benchmark_config["sm_mask"] = "~" + hex(
+                ((1 << active_tpcs) - 1) << tpc_offset)
+    elif part_method != "mig":
+        raise ValueError("Unknown partitioning method: " + part_method)
+    return benchmark_config
+
+def generate_config(part_method, active_tpcs, total_tpcs, device,
+        tpc_offset=0):
+    """Returns a JSON string containing a config that runs the Mandelbrot-set
+    benchmark on a partition containing active_tpcs of the GPU's total_tpcs
+    TPCs, created using the given partitioning method ("mps", "libsmctrl", or
+    "mig"). For MiG, this also reconfigures the GPU as a side effect. See
+    generate_benchmark_config for the meaning of tpc_offset."""
+    if part_method == "mig":
+        setup_mig_instance(active_tpcs, total_tpcs)
+    benchmark_config = generate_benchmark_config(part_method, active_tpcs,
+        total_tpcs, tpc_offset)
+    overall_config = {
+        "name": "Partition granularity: %s" % (part_method),
+        "max_iterations": 100,
+        "max_time": 0,
+        "cuda_device": device,
+        "pin_cpus": True,
+        "benchmarks": [benchmark_config]
+    }
+    return json.dumps(overall_config)
+
+def generate_batched_config(part_method, part_options, total_tpcs, device):
+    """Returns a JSON string containing a single config with one benchmark
+    per partition size in part_options, run as separate processes. Only valid
+    for partitioning methods that don't reconfigure the GPU ("mps" and
+    "libsmctrl")."""
+    benchmarks = []
+    for active_tpcs in part_options:
+        benchmarks.append(generate_benchmark_config(part_method, active_tpcs,
+            total_tpcs))
+    overall_config = {
+        "name": "Partition granularity: %s" % (part_method),
+        "max_iterations": 100,
+        "max_time": 0,
+        "cuda_device": device,
+        "pin_cpus": True,
+        "use_processes": True,
+        "benchmarks": benchmarks
+    }
+    return json.dumps(overall_config)
+
+def start_process(part_method, active_tpcs, total_tpcs, device,
+        tpc_offset=0):
+    """Launches a runner process for a single partition size and returns its
+    Popen handle without waiting for it to complete. See
+    generate_benchmark_config for the meaning of tpc_offset."""
+    print("Testing %s partition with %d / %d TPCs..." % (part_method,
+        active_tpcs, total_tpcs), flush=True)
+    config = generate_config(part_method, active_tpcs, total_tpcs, device,
+        tpc_offset)
+    process = subprocess.Popen(["./bin/runner", "-"], stdin=subprocess.PIPE)
+    process.stdin.write(config.encode("utf-8"))
+    process.stdin.close()
+    return process
+
+def run_process(part_method, active_tpcs, total_tpcs, device):
+    """Runs the benchmark for a single partition size, blocking until the
+    runner process completes."""
+    process = start_process(part_method, active_tpcs, total_tpcs, device)
+    process.wait()
+
+def run_batched(part_method, part_options, total_tpcs, device):
+    """Runs every partition size in part_options in a single runner
+    invocation, paying the CUDA initialization cost once per method instead
+    of once per size. All sizes execute concurrently, so per-size results
+    include any contention between the partitions."""
+    print("Testing %s partitions with %d sizes in one batch..." % (
+        part_method, len(part_options)), flush=True)
+    config = generate_batched_config(part_method, part_options, total_tpcs,
+        device)
+    process = subprocess.Popen(["./bin/runner", "-"], stdin=subprocess.PIPE)
+    process.communicate(input=config.encode("utf-8"))
+
+def find_free_offset(running, active_tpcs, total_tpcs):
+    """Returns the lowest TPC offset at which a contiguous range of
+    active_tpcs TPCs doesn't overlap the range of any running job, or None
+    if no such range currently exists. running holds (process, offset,
+    active_tpcs) tuples."""
+    offset = 0
+    for (used_offset, used_size) in sorted((job[1], job[2])
+            for job in running):
+        if offset + active_tpcs <= used_offset:
+            break
+        offset = max(offset, used_offset + used_size)
+    if offset + active_tpcs > total_tpcs:
+        return None
+    return offset
+
+def run_concurrent(part_method, part_options, total_tpcs, device):
+    """Runs one benchmark per partition size in part_options, allowing runs
+    to execute concurrently so long as every run can be placed on its own
+    disjoint range of TPCs. libsmctrl masks are shifted to each job's
+    assigned range, so overlapping runs never share TPCs. MPS percentages
+    cap each job's share of the GPU, but don't pin jobs to specific TPCs, so
+    concurrent MPS runs may still contend for individual TPCs."""
+    pending = sorted(part_options, reverse=True)
+    running = []
+    while pending or running:
+        # Launch every pending job that currently fits on the GPU, biggest
+        # first, placing each at the lowest free TPC offset.
+        still_pending = []
+        for active_tpcs in pending:
+            offset = find_free_offset(running, active_tpcs, total_tpcs)
+            if offset is not None:
+                process = start_process(part_method, active_tpcs, total_tpcs,
+                    device, offset)
+                running.append((process, offset, active_tpcs))
+            else:
+                still_pending.append(active_tpcs)
+        pending = still_pending
+        time.sleep(0.5)
+        # Reclaim the TPC ranges of any completed runs.
+        running = [job for job in running if job[0].poll() is None]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--device", type=int, default=0,
+        help="The CUDA device to test.")
+    parser.add_argument("-t", "--tpc_count", type=int, default=0,
+        help="The total number of TPCs on the GPU. The default of 0 "
+        "auto-detects the count using pysmctrl.")
+    parser.add_argument("-m", "--methods", nargs="+",
+        choices=["mps", "libsmctrl", "mig"], default=["mps", "libsmctrl"],
+        help="The partitioning methods to test. A full serial sweep takes "
+        "roughly 15 minutes per method.")
+    parser.add_argument("-c", "--concurrent", action="store_true",
+        help="Run multiple partition sizes concurrently when the method "
+        "allows it (mps and libsmctrl only). Concurrent libsmctrl jobs are "
+        "shifted to disjoint TPC ranges; MPS jobs are only capped by thread "
+        "percentage, so concurrent MPS results may include contention that "
+        "a serial sweep wouldn't. MiG runs are always serial, since each "
+        "partition size reconfigures the GPU.")
+    parser.add_argument("-b", "--batch", action="store_true",
+        help="Run all of a method's partition sizes in a single runner "
+        "invocation (mps and libsmctrl only), initializing CUDA once per "
+        "method rather than once per size. All sizes run concurrently, so "
+        "results include contention between partitions.")
+    args = parser.parse_args()
+    # Querying the TPC count opens a CUDA context, so only do it once and
+    # reuse the result for both auto-detection and validation.
+    detected_tpcs = None
+    if pysmctrl is not None:
+        detected_tpcs = pysmctrl.get_tpc_info_cuda(args.device)
+    if args.tpc_count == 0:
+        if detected_tpcs is None:
+            print("pysmctrl is required to auto-detect the TPC count; "
+                "install it or specify --tpc_count manually.")
+            exit(1)
+        tpc_count = detected_tpcs
+    else:
+        tpc_count = args.tpc_count
+    if (detected_tpcs is not None) and (tpc_count > detected_tpcs):
+        print("The GPU doesn't have %d TPCs." % (tpc_count))
+        exit(1)
+    part_options = list(range(1, tpc_count + 1))
+    for part_method in args.methods:
+        if args.batch and (part_method in ("mps", "libsmctrl")):
+            run_batched(part_method, part_options, tpc_count, args.device)
+            continue
+        if args.concurrent and (part_method in ("mps", "libsmctrl")):
+            run_concurrent(part_method, part_options, tpc_count, args.device)
+            continue
+        for active_tpcs in part_options:
+            run_process(part_method, active_tpcs, tpc_count, args.device)
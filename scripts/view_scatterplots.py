@@ -5,15 +5,46 @@
 # field must consist of a single number (may be floating-point). As with the
 # other scripts, one plot will be created for each "name" in the output files.
 #
-# Supports Python 2 and Python 3
+# Requires Python 3
 from __future__ import print_function
 import argparse
 import glob
 import json
-import matplotlib.pyplot as plot
 import numpy
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Set by import_matplotlib; matplotlib is imported lazily since pulling in a
+# GUI backend takes hundreds of milliseconds and isn't needed to print usage
+# errors or --help output.
+plot = None
+
+def import_matplotlib(interactive):
+    """Imports matplotlib and points the module-level "plot" reference at the
+    pyplot module. Uses the non-GUI Agg backend when plots will be saved to
+    files instead of displayed, or when no display is available."""
+    global plot
+    import matplotlib
+    if (not interactive) or (os.environ.get("DISPLAY") is None):
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plot
+
+# orjson parses large result files several times faster than the standard
+# library, but isn't always installed; fall back to the json module if it
+# isn't available.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ijson allows checking a file's "label" field without parsing the whole
+# file, which cheaply filters out files that wouldn't be plotted anyway.
+# It's optional; without it, every file is parsed in full as before.
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 def convert_to_float(s):
     """Takes a string s and parses it as a floating-point number. If s can not
@@ -33,34 +64,25 @@ def benchmark_summary_values(benchmark, times_key):
     for t in benchmark["times"]:
         if times_key not in t:
             continue
-        times = t[times_key]
-        i = 0
-        while i < len(times):
-            duration = times[i + 1] - times[i]
-            durations.append(duration)
-            i += 2
-    minimum = min(durations) * 1000.0
-    maximum = max(durations) * 1000.0
-    average = numpy.mean(durations) * 1000.0
+        # The times array holds [start, end, start, end, ...] pairs; reshape
+        # it to one row per pair and subtract the columns to get durations.
+        times = numpy.asarray(t[times_key], dtype=numpy.float64)
+        times = times.reshape(-1, 2)
+        durations.append(times[:, 1] - times[:, 0])
+    durations = numpy.concatenate(durations)
+    minimum = durations.min() * 1000.0
+    maximum = durations.max() * 1000.0
+    average = durations.mean() * 1000.0
     return [minimum, maximum, average]
 
 def scenario_to_distribution(scenario):
     """Takes a scenario, mapping numbers to triplets, and re-shapes the data.
-    Returns an array of 4 arrays: [[x values], [min y values], [max y values],
-    [average y values]]."""
-    x_values = []
-    for k in scenario:
-        x_values.append(k)
-    x_values.sort()
-    min_y_values = []
-    max_y_values = []
-    mean_y_values = []
-    for k in x_values:
-        triplet = scenario[k]
-        min_y_values.append(triplet[0])
-        max_y_values.append(triplet[1])
-        mean_y_values.append(triplet[2])
-    return [x_values, min_y_values, max_y_values, mean_y_values]
+    Returns an array of 4 numpy arrays: [[x values], [min y values],
+    [max y values], [average y values]], sorted by x value."""
+    rows = numpy.array([(k, v[0], v[1], v[2]) for (k, v) in scenario.items()],
+        dtype=numpy.float64)
+    rows = rows[rows[:, 0].argsort()]
+    return [rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3]]
 
 def add_plot_padding(axes):
     """Takes matplotlib axes, and adds some padding so that lines close to
@@ -78,63 +100,160 @@ def add_plot_padding(axes):
     axes.yaxis.set_ticks(numpy.arange(y_limits[0], y_limits[1] + y_pad,
         y_range / 5.0))
 
+# Marker styles for the three series drawn in each scatterplot. These are
+# module-level constants; plot_scenario only reads them.
+MAX_STYLE = {"label": "Max", "linestyle": "None", "marker": "^",
+    "fillstyle": "full", "markeredgewidth": 0.0, "ms": 7}
+AVERAGE_STYLE = {"label": "Average", "linestyle": "None", "marker": "*",
+    "fillstyle": "full", "markeredgewidth": 0.0, "ms": 8}
+MIN_STYLE = {"label": "Min", "linestyle": "None", "marker": "v",
+    "fillstyle": "full", "markeredgewidth": 0.0, "ms": 7}
+
 def plot_scenario(scenario, name):
     data = scenario_to_distribution(scenario)
     figure = plot.figure()
     figure.suptitle(name)
     axes = figure.add_subplot(1, 1, 1)
     axes.autoscale(enable=True, axis='both', tight=True)
-    axes.plot(data[0], data[2], label="Max", linestyle="None", marker="^",
-        fillstyle="full", markeredgewidth=0.0, ms=7)
-    axes.plot(data[0], data[3], label="Average", linestyle="None", marker="*",
-        fillstyle="full", markeredgewidth=0.0, ms=8)
-    axes.plot(data[0], data[1], label="Min", linestyle="None", marker="v",
-        fillstyle="full", markeredgewidth=0.0, ms=7)
+    # scenario_to_distribution returns numpy float64 arrays, which matplotlib
+    # plots directly without coercing lists to arrays; bind them once here
+    # rather than re-indexing data for every series.
+    x_values = data[0]
+    series = ((data[2], MAX_STYLE), (data[3], AVERAGE_STYLE),
+        (data[1], MIN_STYLE))
+    for (y_values, style) in series:
+        axes.plot(x_values, y_values, **style)
     add_plot_padding(axes)
     axes.set_ylabel("Duration (ms)")
     axes.set_xlabel("Value")
-    legend = plot.legend()
-    legend.draggable()
+    # Build the legend from this figure's axes directly; plot.legend() would
+    # redo the lookup through pyplot's current-figure machinery.
+    legend = axes.legend()
+    try:
+        legend.draggable()
+    except: # matplotlib 3+
+        legend.set_draggable(True)
     return figure
 
-def show_plots(filenames, times_key):
+class PrintBuffer:
+    """Collects progress messages and writes them to stdout in batches.
+    Printing one line per parsed file costs a write syscall per line when
+    output is redirected; batching cuts this to one write per batch_size
+    lines. Call flush() after the last message to emit any remainder."""
+    def __init__(self, batch_size=64):
+        self.batch_size = batch_size
+        self.lines = []
+
+    def add(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.lines) == 0:
+            return
+        sys.stdout.write("\n".join(self.lines) + "\n")
+        sys.stdout.flush()
+        del self.lines[:]
+
+def result_file_label(name):
+    """Streams the named result file with ijson to extract only its top-level
+    "label" field, without building the potentially huge "times" arrays.
+    Returns None if the file has no label."""
+    with open(name, "rb") as f:
+        for value in ijson.items(f, "label"):
+            return value
+    return None
+
+def load_result_file(name):
+    """Reads and parses a single JSON result file. Returns a (name, parsed
+    content, skip reason) tuple. The parsed content will be None, and the
+    skip reason a string, if ijson is available and the file's label is
+    missing or isn't a number, since such files are never plotted and aren't
+    worth parsing in full."""
+    if ijson is not None:
+        label = result_file_label(name)
+        if label is None:
+            return (name, None, "no label in file")
+        if convert_to_float(label) is None:
+            return (name, None, "label isn't a number")
+    with open(name, "rb") as f:
+        # orjson only parses complete buffers, but the standard json module
+        # can read from the file in chunks, avoiding a second copy of the
+        # whole file in memory.
+        if orjson is not None:
+            return (name, orjson.loads(f.read()), None)
+        return (name, json.load(f), None)
+
+def show_plots(filenames, times_key, output_directory=None):
     """Takes a list of filenames and generates one plot per named scenario
-    across all of the files."""
+    across all of the files. If output_directory isn't None, plots are saved
+    as PNG images in the directory rather than displayed interactively."""
+    import_matplotlib(output_directory is None)
     # Maps benchmark names to benchmark data, where the benchmark data is a map
     # of X-values to y-value triplets.
     all_scenarios = {}
     counter = 1
-    for name in filenames:
-        print("Parsing file %d / %d: %s" % (counter, len(filenames), name))
-        counter += 1
-        with open(name) as f:
-            parsed = json.loads(f.read())
+    # Reading and parsing the files is the slow part when plotting a big
+    # directory of results, so overlap the disk reads and parsing using a
+    # thread pool. The results are still consumed in order on this thread.
+    worker_count = min(32, (os.cpu_count() or 1) * 4)
+    progress = PrintBuffer()
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        for name, parsed, skip_reason in executor.map(load_result_file,
+                filenames):
+            progress.add("Parsing file %d / %d: %s" % (counter,
+                len(filenames), name))
+            counter += 1
+            if parsed is None:
+                progress.add("Skipping %s: %s." % (name, skip_reason))
+                continue
             if len(parsed["times"]) < 2:
-                print("Skipping %s: no recorded times in file." % (name))
+                progress.add("Skipping %s: no recorded times in file." % (
+                    name))
+                continue
+            label = parsed.get("label")
+            if label is None:
+                progress.add("Skipping %s: no label in file." % (name))
                 continue
-            float_value = convert_to_float(parsed["label"])
+            float_value = convert_to_float(label)
             if float_value is None:
-                print("Skipping %s: label isn't a number." % (name))
+                progress.add("Skipping %s: label isn't a number." % (name))
                 continue
             summary_values = benchmark_summary_values(parsed, times_key)
             name = parsed["scenario_name"]
             if name not in all_scenarios:
                 all_scenarios[name] = {}
             all_scenarios[name][float_value] = summary_values
+    progress.flush()
     # Draw each scenario's plot.
     figures = []
     for scenario in all_scenarios:
-        figures.append(plot_scenario(all_scenarios[scenario], scenario))
-    plot.show()
+        figures.append((scenario, plot_scenario(all_scenarios[scenario],
+            scenario)))
+    if output_directory is None:
+        plot.show()
+        return
+    for (scenario, figure) in figures:
+        path = os.path.join(output_directory,
+            scenario.replace(" ", "_") + ".png")
+        print("Saving %s" % (path))
+        figure.savefig(path)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-k", "--times_key",
         help="JSON key name for the time property to be plotted.",
         default="execute_times")
+    parser.add_argument("-o", "--output_directory",
+        help="Directory in which to save one PNG image per scenario, rather "
+        "than displaying plots interactively.", default=None)
     parser.add_argument("result_file_to_plot", nargs="*", default=["./results"],
         help="List of result files, or directories of result files, to plot (./results default)")
     args = parser.parse_args()
+    if (args.output_directory is not None and
+        not os.path.isdir(args.output_directory)):
+        os.makedirs(args.output_directory)
     filenames = []
     # If a positional argument is a directory, it's automatically expanded out
     # to include all contained *.json files.
@@ -146,5 +265,5 @@ if __name__ == "__main__":
         else:
             print("Input path '%s' not found as valid file or directory." % f, file=sys.stderr)
             exit(1)
-    show_plots(filenames, args.times_key)
+    show_plots(filenames, args.times_key, args.output_directory)
 